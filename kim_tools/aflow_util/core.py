@@ -1,14 +1,23 @@
 """Tools for working with crystal prototypes using the AFLOW command line tool"""
 import numpy as np
 import json
+import re
+import shlex
 import subprocess
+import threading
 import sys
 import os
+from contextlib import ExitStack
+from tempfile import TemporaryFile
 import ase
 import ase.spacegroup
 from ase.spacegroup.symmetrize import refine_symmetry
-from curses.ascii import isalpha, isupper, isdigit
-from typing import Dict, List, Tuple, Union
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 __author__ = ["ilia Nikiforov", "Ellad Tadmor"]
 __all__ = [
@@ -20,6 +29,43 @@ __all__ = [
     "AFLOW"
 ]
 
+# Number of lattice points in the conventional cell for each centering letter of the Pearson symbol
+CENTERING_DIVISORS = {
+    'P': 1,
+    'C': 2,
+    'I': 2,
+    'F': 4,
+    'R': 3,
+}
+
+# Stoichiometric prefix of a prototype label, i.e. "AB3" in "AB3_cP4_221_a_c", and each species in it with its count
+_STOICH_FORMULA_RE = re.compile(r"(?:[A-Za-z][0-9]*)+")
+_STOICH_COUNT_RE = re.compile(r"[A-Za-z]([0-9]*)")
+
+# Decorations removed from shortnames: ", part 3", and everything from "(part ...", "similar to ..." or "equivalent to ..." on
+_SHORTNAME_CLEANUP_RE = re.compile(r", part 3|\(part .*| (?:similar|equivalent) to.*", re.DOTALL)
+
+# Output of ``aflow --version`` for each AFLOW executable that has been queried, see :meth:`AFLOW.get_aflow_version`
+_AFLOW_VERSIONS: Dict[str, str] = {}
+
+# Output of ``aflow --sgdata`` keyed on the AFLOW executable, ``np`` and the command, see :meth:`AFLOW.get_sgdata_from_prototype`.
+# The oldest entry is dropped once the cache is full
+_SGDATA_OUTPUTS: Dict[Tuple[str, int, Tuple[str, ...]], str] = {}
+_SGDATA_OUTPUTS_MAXSIZE = 1024
+
+
+def _json_loads(output: str):
+    """
+    Parse the JSON output of an AFLOW command, using ``orjson`` if it is installed as it is much faster than the standard library
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(output)
+        except orjson.JSONDecodeError:
+            # orjson rejects non-standard literals such as NaN that the standard library accepts
+            pass
+    return json.loads(output)
+
 
 def get_stoich_reduced_list_from_prototype(prototype_label: str) -> List[int]:
     """
@@ -31,26 +77,24 @@ def get_stoich_reduced_list_from_prototype(prototype_label: str) -> List[int]:
 
     Returns:
         List of reduced stoichiometric numbers
-    """                        
-    stoich_reduced_formula = prototype_label.split("_")[0]
-    stoich_reduced_list=[]
-    stoich_reduced_curr = None
-    for char in stoich_reduced_formula:
-        if isalpha(char):
-            if stoich_reduced_curr is not None:
-                if stoich_reduced_curr == 0:
-                    stoich_reduced_curr = 1
-                stoich_reduced_list.append(stoich_reduced_curr)
-            stoich_reduced_curr = 0
-        else:
-            assert isdigit(char)                            
-            stoich_reduced_curr*=10 # will throw an error if we haven't encountered an alphabetical letter, good
-            stoich_reduced_curr+=int(char)
-    # write final number                    
-    if stoich_reduced_curr == 0:
-        stoich_reduced_curr = 1
-    stoich_reduced_list.append(stoich_reduced_curr)    
-    return stoich_reduced_list
+
+    Raises:
+        RuntimeError:
+            If the stoichiometric part of the label is not a sequence of letters, each optionally followed by a number
+    """
+    return list(_get_stoich_reduced_tuple_from_prototype(prototype_label))
+
+@lru_cache(maxsize=4096)
+def _get_stoich_reduced_tuple_from_prototype(prototype_label: str) -> Tuple[int, ...]:
+    """
+    Cached implementation of :func:`get_stoich_reduced_list_from_prototype`. Returns an immutable tuple
+    so the cached value cannot be modified by callers.
+    """
+    stoich_reduced_formula = prototype_label.split("_", 1)[0]
+    if _STOICH_FORMULA_RE.fullmatch(stoich_reduced_formula) is None:
+        raise RuntimeError("Malformed stoichiometric formula in prototype label %s" % prototype_label)
+    # A missing (or zero) count means 1
+    return tuple(int(count or 0) or 1 for count in _STOICH_COUNT_RE.findall(stoich_reduced_formula))
 
 def get_species_list_from_string(species_string: str) -> List[str]:
     """
@@ -67,17 +111,18 @@ def get_species_list_from_string(species_string: str) -> List[str]:
         RuntimeError:
             If passed a non-alphabetical string
     """
-    if any (not isalpha(character) for character in species_string):
+    # One C-level check of the whole string. An empty string is accepted, as before
+    if species_string and not (species_string.isascii() and species_string.isalpha()):
         raise RuntimeError("Non-alphabetical character in input")
 
+    # Slice each symbol out of the input instead of building it up one character at a time
     species_list=[]
-    curr_species_string=""
-    for character in species_string:
-        if isupper(character) and curr_species_string != "":
-            species_list.append(curr_species_string)
-            curr_species_string = ""
-        curr_species_string+=character
-    species_list.append(curr_species_string)
+    curr_species_start=0
+    for i, character in enumerate(species_string):
+        if 'A' <= character <= 'Z' and i != curr_species_start:
+            species_list.append(species_string[curr_species_start:i])
+            curr_species_start = i
+    species_list.append(species_string[curr_species_start:])
     return species_list
 
 def read_shortnames() -> Dict:
@@ -90,66 +135,66 @@ def read_shortnames() -> Dict:
     Returns:
         A dictionary where the keys are the prototype strings, and the values are the shortnames found in the corresponding lines.
     """
+    return dict(_read_shortnames())
+
+@lru_cache(maxsize=1)
+def _read_shortnames() -> Dict:
+    """
+    Cached implementation of :func:`read_shortnames`. ``README_PROTO.TXT`` is static package data, so it only
+    needs to be parsed once per process. Do not modify the returned dictionary, :func:`read_shortnames` returns a copy.
+    """
     shortnames = {}
     shortname_file = "data/README_PROTO.TXT"
     notes_index = None
     with open(os.path.dirname(os.path.realpath(__file__))+'/'+shortname_file, encoding="utf-8") as f:
-        for line in f:
-            line = line.strip()
-            if line.startswith("ANRL Label"):
-                try:
-                    notes_index = line.index("notes")
-                    continue
-                except:
-                    print("ERROR: ANRL Label line without notes header")
-                    print(line)
-                    sys.exit()
-            # Skip this line if it's before the first ANRL label
-            if notes_index == None:
-                continue
-            # Skip this line if it's empty, a comment, or a divider
-            if (
-                line == ""
-                or line == "\n"
-                or line.startswith("*")
-                or line.startswith("-")
-                or line.startswith("ANRL")
-            ):
-                continue
-            # Skip this line if it only has content in the first column
-            # (prototype runover from previous line)
-            try:
-                dum = line.split(" ")[1]
-            except:
-                continue
-            # Clean up prototype (remove decorations suffix)
-            prototype = line.split(" ")[0]
-            if "." in prototype:
-                idx = prototype.index(".")
-                prototype = prototype[:idx]
-            # Clean up short name
-            sname = line[notes_index:]
-            if "(part " in sname:
-                idx = sname.index("(part")
-                sname = sname[:idx]
-            sname = sname.replace(", part 3", "")
-            if "ICSD" in sname:
-                idx = sname.index("ICSD")
-                tmp = sname[idx:].split(" ")[1]
-                if tmp.endswith(","):
-                    sname = sname[:idx] + "ICSD " + tmp[:-1]
-            if " similar to" in sname:
-                idx = sname.index(" similar to")
-                sname = sname[:idx]
-            if " equivalent to" in sname:
-                idx = sname.index(" equivalent to")
-                sname = sname[:idx]
-            if sname.endswith(","):
-                sname = sname[:-1]
-            # add prototype to shortnames dictionary
-            shortnames[prototype] = sname.rstrip()
+        lines = f.read().splitlines()
+    for line in lines:
+        line = line.strip()
+        if line.startswith("ANRL Label"):
+            if "notes" not in line:
+                print("ERROR: ANRL Label line without notes header")
+                print(line)
+                sys.exit()
+            notes_index = line.index("notes")
+            continue
+        # Skip this line if it's before the first ANRL label
+        if notes_index == None:
+            continue
+        # Skip this line if it's empty, a comment, or a divider
+        if line == "" or line.startswith(("*", "-", "ANRL")):
+            continue
+        # Skip this line if it only has content in the first column
+        # (prototype runover from previous line)
+        if " " not in line:
+            continue
+        # Clean up prototype (remove decorations suffix)
+        prototype = line.partition(" ")[0].partition(".")[0]
+        # Clean up short name
+        sname = _SHORTNAME_CLEANUP_RE.sub("", line[notes_index:])
+        before_icsd, icsd, after_icsd = sname.partition("ICSD")
+        if icsd:
+            tmp = after_icsd.split(" ")[1]
+            if tmp.endswith(","):
+                sname = before_icsd + "ICSD " + tmp[:-1]
+        if sname.endswith(","):
+            sname = sname[:-1]
+        # add prototype to shortnames dictionary
+        shortnames[prototype] = sname.rstrip()
     return shortnames
 
+@lru_cache(maxsize=8)
+def _get_shortname_matcher(prototypes: Tuple[str, ...]) -> "re.Pattern":
+    """
+    Compile a single regular expression that finds any of ``prototypes`` as a substring, so that a name can be
+    checked against all of them in one pass instead of one ``in`` test per prototype
+    """
+    if len(prototypes) == 0:
+        # an empty alternation would match everything
+        return re.compile("(?!)")
+    # Longest first, so that where several prototypes match at the same position the most specific one is reported
+    return re.compile("|".join(map(re.escape, sorted(prototypes, key=len, reverse=True))))
+
+@lru_cache(maxsize=4096)
 def get_formula_from_prototype(prototype_label: str) -> Tuple[str,int,int]:
     """
     Returns the stoichiometric formula, number of independent species in it,
@@ -167,22 +212,12 @@ def get_formula_from_prototype(prototype_label: str) -> Tuple[str,int,int]:
 
     """
     # Verify that the number species matches the prototype
-    formula = prototype_label.split("_")[0]
-    letters = "".join([char for char in formula if not char.isdigit()])
-    number_independent_species = len(letters)
-
-    # Compute number of atoms per formula
-    number_atoms_per_formula = 0
-    for i in range(number_independent_species):
-        i1 = formula.index(letters[i])
-        if i < number_independent_species - 1:
-            i2 = formula.index(letters[i + 1])
-        else:
-            i2 = len(formula)
-        if i2 - i1 > 1:
-            number_atoms_per_formula += int(formula[i1 + 1 : i2])
-        else:
-            number_atoms_per_formula += 1
+    formula = prototype_label.split("_", 1)[0]
+    counts = _STOICH_COUNT_RE.findall(formula)
+    number_independent_species = len(counts)
+
+    # Compute number of atoms per formula in a single pass
+    number_atoms_per_formula = sum(int(count) if count else 1 for count in counts)
 
     # Return results
     return formula, number_independent_species, number_atoms_per_formula
@@ -206,7 +241,7 @@ def get_wyckoff_info_and_cell(sgdata: Dict) -> Tuple[List[str],np.ndarray,np.nda
         wyckoff_coordinates_list.append(wyck["position"])
         wyckoff_types.append(wyck["name"])
     wyckoff_coordinates = np.array(wyckoff_coordinates_list)
-    cell = sgdata["wyccar"]["lattice"]
+    cell = np.asarray(sgdata["wyccar"]["lattice"], dtype=np.float64)
     return wyckoff_types, wyckoff_coordinates, cell
 
 class AFLOW:
@@ -254,31 +289,148 @@ class AFLOW:
         else:
             self.aflow_work_dir = aflow_work_dir
 
-    def aflow_command(self, cmd: List[str]) -> str:
+    def _get_command_string(self, cmd: List[str]) -> str:
+        """
+        Build the shell command line equivalent to a command passed to :meth:`aflow_command`, for use in error messages
+        """
+        cmd_list = [self.aflow_executable + " --np=" + str(self.np) + cmd_inst
+            for cmd_inst in cmd]
+        return " | ".join(cmd_list)
+
+    def _raise_command_error(self, cmd_str: str, returncode: int, stderr: str):
+        """
+        Raise the appropriate exception for a failed AFLOW command
+        """
+        if "--proto=" in cmd_str and "The structure has a higher symmetry than indicated by the label. The correct label and parameters for this structure are:" in str(stderr):
+            raise self.tooSymmetricException("WARNING: the following command refused to write a POSCAR because it detected a higher symmetry: %s"%cmd_str)
+        else:
+            raise RuntimeError("ERROR: unexpected error from aflow command %s , error code = %d\nstderr: %s" % (cmd_str, returncode, stderr))
+
+    def _split_redirections(self, cmd_inst: str) -> Tuple[List[str], Union[str,None], Union[str,None]]:
         """
-        Run AFLOW executable with specified arguments and return the output, possibly multiple times piping outputs to each other     
+        Split a single AFLOW command into an argument list, separating out shell-style ``< input_file`` and
+        ``> output_file`` redirections
+
+        Returns:
+            * Argument list, starting with the AFLOW executable
+            * Path to redirect stdin from, or ``None``
+            * Path to redirect stdout to, or ``None``
+        """
+        args = [self.aflow_executable, "--np=" + str(self.np)]
+        stdin_path = None
+        stdout_path = None
+        tokens = iter(shlex.split(cmd_inst))
+        for token in tokens:
+            if token in ("<", ">"):
+                path = next(tokens, None)
+                if path is None:
+                    raise RuntimeError("ERROR: missing file name after '%s' in aflow command %s" % (token, cmd_inst))
+                if token == "<":
+                    stdin_path = path
+                else:
+                    stdout_path = path
+            else:
+                args.append(token)
+        return args, stdin_path, stdout_path
+
+    @staticmethod
+    def _cleanup_processes(procs: List[subprocess.Popen]):
+        """
+        Kill any process of a pipeline that is still running, close its pipes and wait for it, so that
+        nothing is left behind if the pipeline fails part way through
+        """
+        for proc in procs:
+            if proc.poll() is None:
+                proc.kill()
+            for pipe in (proc.stdin, proc.stdout):
+                if pipe is not None:
+                    pipe.close()
+            proc.wait()
+
+    @staticmethod
+    def _write_and_close(stdin, input: str):
+        """
+        Write ``input`` to a process's stdin and close it. Used to feed a pipeline from a separate thread
+        """
+        try:
+            stdin.write(input)
+            stdin.close()
+        except BrokenPipeError:
+            # the process exited without reading all of its input. Its exit code is checked by the caller
+            pass
+
+    def aflow_command(self, cmd: List[str], input: Union[str,None] = None) -> str:
+        """
+        Run AFLOW executable with specified arguments and return the output, possibly multiple times piping outputs to each other.
+        The processes are started directly, without a shell. ``< input_file`` and ``> output_file`` redirections
+        in the arguments are still supported.
 
         Args:
             cmd: List of arguments to pass to each AFLOW executable. If it's longer than 1, multiple commands will be piped to each other
+            input: Text to pass to the stdin of the first command, instead of reading it from a file. Ignored if the first
+                command has a ``< input_file`` redirection
 
         Raises:
             tooSymmetricException: if an ``aflow --proto=`` command complains that 
                 ``the structure has a higher symmetry than indicated by the label`` 
+            RuntimeError: if the command is malformed, can't be started, or exits with an error
         
         Returns:
             Output of the AFLOW command
         """
-        cmd_list = [self.aflow_executable + " --np=" + str(self.np) + cmd_inst
-            for cmd_inst in cmd]
-        cmd_str = " | ".join(cmd_list)                
-        try:
-            return subprocess.check_output(cmd_str, shell=True, stderr=subprocess.PIPE,encoding="utf-8")
-        except subprocess.CalledProcessError as exc:
-            if "--proto=" in cmd_str and "The structure has a higher symmetry than indicated by the label. The correct label and parameters for this structure are:" in str(exc.stderr):
-                raise self.tooSymmetricException("WARNING: the following command refused to write a POSCAR because it detected a higher symmetry: %s"%cmd_str)
-            else:
-                raise RuntimeError("ERROR: unexpected error from aflow command %s , error code = %d\nstderr: %s" % (cmd_str, exc.returncode, exc.stderr))
-    
+        cmd_str = self._get_command_string(cmd)
+        # Parse every stage before starting anything, so a malformed command can't leave processes behind
+        stages = [self._split_redirections(cmd_inst) for cmd_inst in cmd]
+        with ExitStack() as stack:
+            procs = []
+            # Runs last, after the files below are closed, whether or not the pipeline succeeded
+            stack.callback(self._cleanup_processes, procs)
+            try:
+                # All processes share one stderr file, like they would in a shell pipeline.
+                # A file rather than a pipe means an upstream process can never block on a full stderr buffer
+                stderr_file = stack.enter_context(TemporaryFile("w+", encoding="utf-8"))
+                # Open all redirections up front, so a missing or unwritable file fails before any process is started
+                redirections = [
+                    (None if stdin_path is None else stack.enter_context(open(stdin_path)),
+                     None if stdout_path is None else stack.enter_context(open(stdout_path, "w")))
+                    for _, stdin_path, stdout_path in stages]
+                prev_stdout = None
+                for i, ((args, _, _), (stdin_file, stdout_file)) in enumerate(zip(stages, redirections)):
+                    if stdin_file is not None:
+                        stdin = stdin_file
+                    elif i == 0:
+                        stdin = None if input is None else subprocess.PIPE
+                    elif prev_stdout is None:
+                        # previous command's output was redirected to a file
+                        stdin = subprocess.DEVNULL
+                    else:
+                        stdin = prev_stdout
+                    stdout = subprocess.PIPE if stdout_file is None else stdout_file
+                    proc = subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr_file, encoding="utf-8")
+                    procs.append(proc)
+                    if prev_stdout is not None:
+                        # the child has its own copy now. Closing ours lets the upstream process get SIGPIPE if the downstream one exits
+                        prev_stdout.close()
+                    prev_stdout = proc.stdout
+                if procs[0].stdin is not None and len(procs) > 1:
+                    # Feed the pipeline from another thread, otherwise a full pipe further down could deadlock it
+                    writer = threading.Thread(target=self._write_and_close, args=(procs[0].stdin, input))
+                    writer.start()
+                    output, _ = procs[-1].communicate()
+                    writer.join()
+                else:
+                    output, _ = procs[-1].communicate(None if procs[-1].stdin is None else input)
+                for proc in procs[:-1]:
+                    proc.wait()
+            except OSError as exc:
+                raise RuntimeError("ERROR: unable to run aflow command %s\n%s" % (cmd_str, exc)) from exc
+            # As in a shell pipeline, the exit status is that of the last command
+            returncode = procs[-1].returncode
+            if returncode != 0:
+                stderr_file.seek(0)
+                self._raise_command_error(cmd_str, returncode, stderr_file.read())
+        return "" if output is None else output
+
     def write_poscar(self, prototype_label: str, output_file: Union[str,None]=None, free_params: Union[List[float],None]=None):
         """
         Run the ``aflow --proto`` command to write a POSCAR coordinate file corresponding to the provided AFLOW prototype designation
@@ -290,7 +442,7 @@ class AFLOW:
         """
         command = " --proto=" + prototype_label
         if free_params:
-            command += " --params=" + ",".join([str(param) for param in free_params])
+            command += " --params=" + ",".join(map(str, free_params))
         if output_file is not None:
             command += " > " + self.aflow_work_dir + output_file
         return self.aflow_command([command])
@@ -317,7 +469,7 @@ class AFLOW:
         output=self.aflow_command([
             command + " --screen_only --quiet --print=json"
             ])
-        res_json = json.loads(output)
+        res_json = _json_loads(output)
         return res_json
 
     def get_aflow_version(self)-> str:
@@ -327,47 +479,83 @@ class AFLOW:
         Returns:
             aflow++ executable version
         """
-        command = " --version"        
-        output = self.aflow_command([command])
-        return output.strip().split()[2]
+        # The version can't change while we are running, and AFLOW objects are short-lived, so cache it per executable
+        if self.aflow_executable not in _AFLOW_VERSIONS:
+            command = " --version"
+            output = self.aflow_command([command])
+            _AFLOW_VERSIONS[self.aflow_executable] = output.strip().split()[2]
+        return _AFLOW_VERSIONS[self.aflow_executable]
+
+    def get_prim_poscar(self, input_file: Union[str,None] = None, poscar: Union[str,None] = None) -> str:
+        """
+        Run the ``aflow --prim`` command to get the primitive cell of the input structure
+
+        Args:
+            input_file: path to the POSCAR file containing the structure
+            poscar: contents of the POSCAR file, piped directly to AFLOW. Used if ``input_file`` is not given
+
+        Returns:
+            POSCAR file contents of the primitive cell
+        """
+        return self._aflow_command_on_input(" --prim", input_file, poscar, prim=False)
 
-    def compare_to_prototypes(self, input_file: str) -> List[Dict]:
+    def _aflow_command_on_input(self, command: str, input_file: Union[str,None], poscar: Union[str,None], prim: bool) -> str:
+        """
+        Run ``command`` on the structure in ``input_file``, or on the ``poscar`` contents piped to stdin if ``input_file``
+        is not given, optionally piping it through ``aflow --prim`` first
+        """
+        if input_file is None:
+            if poscar is None:
+                raise RuntimeError("ERROR: either an input file or the contents of a POSCAR file must be provided")
+            redirect = ""
+        else:
+            redirect = " < " + self.aflow_work_dir + input_file
+            poscar = None
+        if prim:
+            cmd = [" --prim" + redirect, command]
+        else:
+            cmd = [command + redirect]
+        return self.aflow_command(cmd, input=poscar)
+
+    def compare_to_prototypes(self, input_file: Union[str,None] = None, prim: bool = True, poscar: Union[str,None] = None) -> List[Dict]:
         """
         Run the ``aflow --compare2prototypes`` command to compare the input structure to the AFLOW library of curated prototypes
 
         Args:
             input_file: path to the POSCAR file containing the structure to compare
+            prim: Convert the structure to its primitive cell using ``aflow --prim`` first. Set to ``False`` if ``input_file``
+                was already written by :meth:`get_prim_poscar`
+            poscar: contents of the POSCAR file, piped directly to AFLOW. Used if ``input_file`` is not given
 
         Returns:
             JSON list of dictionaries containing information about matching prototypes. In practice, this list should be of length zero or 1
         """
 
-        output = self.aflow_command([            
-            " --prim < " + self.aflow_work_dir + input_file,
-            " --compare2prototypes --catalog=anrl --quiet --print=json"
-        ])
-        res_json = json.loads(output)
+        output = self._aflow_command_on_input(
+            " --compare2prototypes --catalog=anrl --quiet --print=json", input_file, poscar, prim)
+        res_json = _json_loads(output)
         return res_json
     
-    def get_prototype(self,input_file: str) -> Dict:
+    def get_prototype(self,input_file: Union[str,None] = None, prim: bool = True, poscar: Union[str,None] = None) -> Dict:
         """
         Run the ``aflow --prototype`` command to get the AFLOW prototype designation of the input structure
 
         Args:
             input_file: path to the POSCAR file containing the structure to analyze
+            prim: Convert the structure to its primitive cell using ``aflow --prim`` first. Set to ``False`` if ``input_file``
+                was already written by :meth:`get_prim_poscar`
+            poscar: contents of the POSCAR file, piped directly to AFLOW. Used if ``input_file`` is not given
 
         Returns:
             JSON dictionaries describing the AFLOW prototype designation (label and parameters) of the input structure.
        
         """
-        output=self.aflow_command([
-            " --prim < " + self.aflow_work_dir + input_file,
-            " --prototype --print=json"
-            ])
-        res_json = json.loads(output)
+        output=self._aflow_command_on_input(
+            " --prototype --print=json", input_file, poscar, prim)
+        res_json = _json_loads(output)
         return res_json    
 
-    def get_library_prototype_label_and_shortname(self, poscar_file: str,shortnames: Dict = read_shortnames()) -> Tuple[Union[str,None],Union[str,None]]:
+    def get_library_prototype_label_and_shortname(self, poscar_file: Union[str,None] = None,shortnames: Optional[Dict] = None, prim: bool = True, poscar: Union[str,None] = None) -> Tuple[Union[str,None],Union[str,None]]:
         """
         Use the aflow command line tool to determine the library prototype label for a structure and look up its human-readable shortname.
         In the case of multiple results, the enumeration with the smallest misfit that is in the prototypes list is returned. If none
@@ -378,13 +566,21 @@ class AFLOW:
                 Path to input coordinate file
             shortnames:
                 Dictionary with library prototype labels as keys and human-readable "shortnames" as values.
+                If not given, the dictionary returned by :func:`read_shortnames` is used
+            prim:
+                Convert the structure to its primitive cell using ``aflow --prim`` first. Set to ``False`` if ``poscar_file``
+                was already written by :meth:`get_prim_poscar`
+            poscar:
+                Contents of the POSCAR file, piped directly to AFLOW. Used if ``poscar_file`` is not given
 
         Returns:
             * The library prototype label for the provided compound.
             * Shortname corresponding to this prototype
         """
 
-        comparison_results = self.compare_to_prototypes(poscar_file)
+        if shortnames is None:
+            shortnames = _read_shortnames()
+        comparison_results = self.compare_to_prototypes(poscar_file, prim, poscar)
         if len(comparison_results) > 1:
             # If zero results are returned it means the prototype is not in the encyclopedia at all        
             # Not expecting a case where the number of results is greater than 1.
@@ -397,31 +593,27 @@ class AFLOW:
             return None, None
 
         # Try to find the result with the smallest misfit that is in the matching
-        # prototype list, otherwise return result with smallest misfit
-        misfit_min_overall = 1e60
-        found_overall = False
-        misfit_min_inlist = 1e60
-        found_inlist = False
-
+        # prototype list, otherwise return result with smallest misfit.
+        # The sort is stable, so ties keep AFLOW's order. This makes the first result the best overall, and
+        # the first result in the list the best in-list one, so the search can stop there.
+        structures_duplicate = sorted(comparison_results[0]["structures_duplicate"], key=lambda struct: struct["misfit"])
+        if len(structures_duplicate) == 0:
+            return None, None
+        matching_library_prototype_label = structures_duplicate[0]["name"]
         shortname = None
-        for struct in comparison_results[0]["structures_duplicate"]:
-            if struct["misfit"] < misfit_min_overall:
-                misfit_min_overall = struct["misfit"]
-                library_proto_overall = struct["name"]
-                found_overall = True
-            if struct["misfit"] < misfit_min_inlist and any(
-                proto in struct["name"] for proto in shortnames
-            ):
-                misfit_min_inlist = struct["misfit"]
-                library_proto_inlist = struct["name"]
-                found_inlist = True
-        if found_inlist:
-            matching_library_prototype_label = library_proto_inlist
-            shortname = shortnames[matching_library_prototype_label]
-        elif found_overall:
-            matching_library_prototype_label = library_proto_overall
-        else:
-            matching_library_prototype_label = None
+        shortname_matcher = _get_shortname_matcher(tuple(shortnames))
+        for struct in structures_duplicate:
+            # AFLOW usually reports the library label exactly, so try a dict lookup before scanning for a substring
+            if struct["name"] in shortnames:
+                shortname_key = struct["name"]
+            else:
+                match = shortname_matcher.search(struct["name"])
+                if match is None:
+                    continue
+                shortname_key = match.group()
+            matching_library_prototype_label = struct["name"]
+            shortname = shortnames[shortname_key]
+            break
 
         return matching_library_prototype_label, shortname
 
@@ -441,11 +633,19 @@ class AFLOW:
             JSON dict containing space group information of the structure
         """
         command = [
-            " --proto="+":".join([prototype_label]+species)+" --params=" + ",".join([str(param) for param in parameter_values]),
+            " --proto="+":".join((prototype_label, *species))+" --params=" + ",".join(map(str, parameter_values)),
             " --sgdata --print=json"
             ]
-        output = self.aflow_command(command)
-        res_json = json.loads(output)
+        # The output only depends on the command and the executable, so repeated prototypes don't need to re-run AFLOW.
+        # The text is cached rather than the parsed dict so each caller gets its own copy
+        cache_key = (self.aflow_executable, self.np, tuple(command))
+        output = _SGDATA_OUTPUTS.get(cache_key)
+        if output is None:
+            output = self.aflow_command(command)
+            if len(_SGDATA_OUTPUTS) >= _SGDATA_OUTPUTS_MAXSIZE:
+                _SGDATA_OUTPUTS.pop(next(iter(_SGDATA_OUTPUTS)), None)
+            _SGDATA_OUTPUTS[cache_key] = output
+        res_json = _json_loads(output)
         return res_json
 
     def build_atoms_from_prototype(self, species: List[str], prototype_label: str, parameter_values: List[float], primitive_cell: bool = False, verbose: bool=True):
@@ -489,14 +689,10 @@ class AFLOW:
         if centering == 'R':
             num_conv_cell *= 3
 
-        if (not primitive_cell) or (centering == 'P'):
+        if primitive_cell:
+            num_lattice = CENTERING_DIVISORS[centering]
+        else:
             num_lattice = 1
-        elif (centering == 'C') or (centering == 'I'):
-            num_lattice = 2
-        elif centering == 'F':
-            num_lattice = 4
-        elif centering == 'R':
-            num_lattice = 3
         
         if num_conv_cell % num_lattice != 0:
             raise self.incorrectNumAtomsException("WARNING: Number of atoms in conventional cell %d derived from Pearson symbol of prototype %s is not divisible by the number of lattice points %d"%(num_conv_cell,prototype_label,num_lattice))
@@ -545,4 +741,4 @@ class AFLOW:
         if dataset["number"]!=spacegroup:
             raise self.incorrectSpaceGroupException("WARNING: spglib spacegroup %d does not match AFLOW prototype %s"%(dataset["number"],prototype_label))
 
-        return atoms
\ No newline at end of file
+        return atoms
@@ -42,7 +42,7 @@ elif hasattr(symmetrize,'FixSymmetry'):
     from ase.spacegroup.symmetrize import FixSymmetry
 else:
     raise ImportError("Can't find `FixSymmetry` in either `ase.constraints` or `ase.spacegroup.symmetrize`")
-from typing import Any, Optional, List, Union, Dict, IO
+from typing import Any, Optional, List, Union, Dict, IO, Tuple
 from ase.optimize import LBFGSLineSearch
 from ase.optimize.optimize import Optimizer
 from ase.constraints import ExpCellFilter, UnitCellFilter
@@ -51,8 +51,9 @@ from kim_property import kim_property_create, kim_property_modify, kim_property_
 from kim_property.modify import STANDARD_KEYS_SCLAR_OR_WITH_EXTENT
 import kim_edn
 from .. import aflow_util
-from kim_query import raw_query
-from tempfile import NamedTemporaryFile
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from copy import deepcopy
 import os
 from warnings import warn
 from io import StringIO
@@ -280,6 +281,7 @@ class KIMTestDriver(ABC):
         for existing_property in existing_properties:
             if existing_property == property_name or get_property_id_path(existing_property)[3] == property_name:
                 property_in_existing_properties = True
+                break
 
         if not property_in_existing_properties:
             print('\nThe property name or id\n%s\nwas not found in kim-properties.\n'%property_name)
@@ -465,6 +467,13 @@ def get_crystal_genome_designation_from_atoms(atoms: Atoms, aflow_np = 1) -> Dic
     """
     Get crystal genome designation from an ASE atoms object.
 
+    Args:
+        atoms:
+            Structure to analyze
+        aflow_np:
+            Number of cores each AFLOW process may use. With the default of 1, two independent AFLOW queries
+            are run at the same time. Otherwise they are run one after the other, so no more than ``aflow_np`` cores are used
+
     Returns:
         A dictionary with the following keys:
             stoichiometric_species: List[str]
@@ -482,17 +491,14 @@ def get_crystal_genome_designation_from_atoms(atoms: Atoms, aflow_np = 1) -> Dic
             short_name: Optional[List[str]]
                 List of human-readable short names (e.g. "Face-Centered Cubic"), if present
     """
-    aflow = aflow_util.AFLOW(np=aflow_np)
-    cg_des = {}
-    
-    with NamedTemporaryFile('w',delete=False) as fp: #KDP has python3.8 which is missing the convenient `delete_on_close` option
-        atoms.write(fp,sort=True,format='vasp')
-        fp.close()
-        with open(fp.name) as f:
-            proto_des = aflow.get_prototype(f.name)
-            libproto,short_name = aflow.get_library_prototype_label_and_shortname(f.name,aflow_util.read_shortnames())
-        os.remove(fp.name)
+    with StringIO() as output:
+        atoms.write(output,sort=True,format='vasp')
+        poscar = output.getvalue()
+    proto_des,libproto,short_name = _get_aflow_designation_from_poscar(poscar,aflow_np)
+    # the AFLOW results are cached, copy them so the caller can't modify the cache
+    proto_des = deepcopy(proto_des)
 
+    cg_des = {}
     cg_des["prototype_label"] = proto_des["aflow_prototype_label"]
     cg_des["stoichiometric_species"] = sorted(list(set(atoms.get_chemical_symbols())))
     parameter_names = proto_des["aflow_prototype_params_list"][1:]
@@ -509,6 +515,36 @@ def get_crystal_genome_designation_from_atoms(atoms: Atoms, aflow_np = 1) -> Dic
 
     return cg_des
 
+@lru_cache(maxsize=128)
+def _get_aflow_designation_from_poscar(poscar: str, aflow_np: int) -> Tuple[Dict, Optional[str], Optional[str]]:
+    """
+    Run the AFLOW queries needed by :func:`get_crystal_genome_designation_from_atoms`. AFLOW only sees the POSCAR file,
+    so the results are cached keyed on its contents to avoid re-running AFLOW on structures that have already been analyzed.
+    Do not modify the returned objects.
+
+    Returns:
+        * Output of :meth:`aflow_util.AFLOW.get_prototype`
+        * Library prototype label and shortname returned by :meth:`aflow_util.AFLOW.get_library_prototype_label_and_shortname`
+    """
+    aflow = aflow_util.AFLOW(np=aflow_np)
+
+    # Both queries below start from the primitive cell, so only run ``aflow --prim`` once.
+    # The structures are piped to AFLOW's stdin, so no POSCAR files are written
+    prim_poscar = aflow.get_prim_poscar(poscar=poscar)
+    if aflow_np == 1:
+        # The two queries are independent single-core aflow processes, so let them run at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            proto_des_future = executor.submit(aflow.get_prototype,prim=False,poscar=prim_poscar)
+            libproto_future = executor.submit(aflow.get_library_prototype_label_and_shortname,prim=False,poscar=prim_poscar)
+            proto_des = proto_des_future.result()
+            libproto,short_name = libproto_future.result()
+    else:
+        # Each query already uses aflow_np cores, running both at once would use twice what the caller asked for
+        proto_des = aflow.get_prototype(prim=False,poscar=prim_poscar)
+        libproto,short_name = aflow.get_library_prototype_label_and_shortname(prim=False,poscar=prim_poscar)
+
+    return proto_des,libproto,short_name
+
 ################################################################################
 def verify_unchanged_symmetry(
     reference_stoichiometric_species: List[str],
@@ -531,16 +567,16 @@ def verify_unchanged_symmetry(
         KIMTestDriverError:
             If the symmetries of the reference and test structures are different.
     """
-    checking_full_label = True
-    if (int(reference_prototype_label.split("_")[2]) < 16) and loose_triclinic_and_monoclinic: # triclinic or monoclinic space group
-        checking_full_label = False
-
-    if checking_full_label:
-        if reference_prototype_label != prototype_label:
+    # Identical labels pass regardless of how strictly we are checking, so only parse the labels if they differ
+    if reference_prototype_label != prototype_label:
+        # split the reference label once and reuse the parts below. Only the first three fields
+        # (stoichiometry, Pearson symbol, space group) are ever compared, so don't split the Wyckoff letters
+        reference_prototype_label_list = reference_prototype_label.split("_", 3)
+        if (int(reference_prototype_label_list[2]) < 16) and loose_triclinic_and_monoclinic: # triclinic or monoclinic space group
+            if reference_prototype_label_list[:3] != prototype_label.split("_", 3)[:3]:
+                raise KIMTestDriverError("AFLOW prototype label %s differs from reference prototype label %s even when ignoring Wyckoff letters"%(prototype_label,reference_prototype_label))
+        else:
             raise KIMTestDriverError("AFLOW prototype label %s differs from reference prototype label %s" % (prototype_label,reference_prototype_label))
-    else:
-        if reference_prototype_label.split("_")[:3] != prototype_label.split("_")[:3]:
-            raise KIMTestDriverError("AFLOW prototype label %s differs from reference prototype label %s even when ignoring Wyckoff letters"%(prototype_label,reference_prototype_label))
         
     if reference_stoichiometric_species != stoichiometric_species:
         raise KIMTestDriverError("List of stoichiometric species %s does not match reference list %s" % (stoichiometric_species,reference_stoichiometric_species))
@@ -887,6 +923,9 @@ def query_crystal_genome_structures(
                 short_name: Optional[List[str]]
                     List of human-readable short names (e.g. "Face-Centered Cubic"), if present
     """
+    # kim_query pulls in an HTTP client that is slow to import and only needed here
+    from kim_query import raw_query
+
     stoichiometric_species.sort()
 
     # TODO: Some kind of generalized query interface for all tests, this is very hand-made
@@ -0,0 +1,213 @@
+#!/usr/bin/python
+
+import stat
+import subprocess
+import sys
+
+import pytest
+
+from kim_tools import aflow_util
+from kim_tools.aflow_util import (
+    AFLOW,
+    get_formula_from_prototype,
+    get_species_list_from_string,
+    get_stoich_reduced_list_from_prototype,
+    read_shortnames,
+)
+
+STUB_AFLOW = """#!{python}
+import sys
+args = sys.argv[2:] # skip --np=N
+if args[0] == "--cat":
+    sys.stdout.write(sys.stdin.read())
+elif args[0] == "--upper":
+    sys.stdout.write(sys.stdin.read().upper())
+elif args[0] == "--echo":
+    sys.stdout.write(" ".join(sys.argv[1:]))
+elif args[0] == "--fail":
+    sys.stderr.write("boom")
+    sys.exit(3)
+elif args[0].startswith("--proto="):
+    sys.stderr.write("The structure has a higher symmetry than indicated by the label. The correct label and parameters for this structure are:")
+    sys.exit(1)
+"""
+
+
+@pytest.mark.parametrize("prototype_label,stoich_reduced_list,formula", [
+    ("A_cF4_225_a", [1], ("A", 1, 1)),
+    ("AB3_cP4_221_a_c", [1, 3], ("AB3", 2, 4)),
+    ("A2B_mC12_12_2i_i", [2, 1], ("A2B", 2, 3)),
+    ("A10B2C_tP13_1_a_b_c", [10, 2, 1], ("A10B2C", 3, 13)),
+    ("AB12C3_x", [1, 12, 3], ("AB12C3", 3, 16)),
+])
+def test_prototype_label_parsing(prototype_label, stoich_reduced_list, formula):
+    assert get_stoich_reduced_list_from_prototype(prototype_label) == stoich_reduced_list
+    assert get_formula_from_prototype(prototype_label) == formula
+
+
+@pytest.mark.parametrize("prototype_label", ["1A_cF4_225_a", "A-B_cP2_221_a_b", "", "\u00c5_cF4_225_a", "A\u00b2_x"])
+def test_malformed_prototype_label(prototype_label):
+    with pytest.raises(RuntimeError):
+        get_stoich_reduced_list_from_prototype(prototype_label)
+
+
+@pytest.mark.parametrize("species_string,species_list", [
+    ("", [""]),
+    ("Ar", ["Ar"]),
+    ("CSi", ["C", "Si"]),
+    ("MoS", ["Mo", "S"]),
+    ("AlCoCrFeNi", ["Al", "Co", "Cr", "Fe", "Ni"]),
+])
+def test_species_list_from_string(species_string, species_list):
+    assert get_species_list_from_string(species_string) == species_list
+
+
+@pytest.mark.parametrize("species_string", ["C1", "C Si", "\u00c5", "Al\u00e9"])
+def test_species_list_from_invalid_string(species_string):
+    with pytest.raises(RuntimeError):
+        get_species_list_from_string(species_string)
+
+
+@pytest.mark.parametrize("prototype,shortname", [
+    ("A_cF4_225_a", "Face-Centered Cubic"), # "(part 1), equivalent to ..."
+    ("AB_cP2_221_b_a", "CsCl"), # decorated label in README_PROTO.TXT
+    ("A_aP4_2_aci-001", "Cf"), # "(part 1)"
+    ("AB_oP8_62_c_c-005", "Westerveldite/eta-NiSi"), # "(part 2/part 3); ... similar to ..."
+    ("ABC6D2_mC40_15_e_e_3f_f-001", "Esseneite/Diopside"), # "(part 1/part 3), ... similar to ..."
+    ("A2B_tP12_92_b_a-002", "O2Ti binary oxide (R. Friedrich), ICSD #161691"), # "ICSD #161691, equivalent to ..."
+    ("AB2_tI6_139_a_e-004", "KO2 binary oxide (R. Friedrich), ICSD #38245"),
+    ("AB_aP16_2_4i_4i-001", "bcc-SQS [10.1103/PhysRevB.69.214202] (O. Levy)"), # "(O. Levy, part 3)"
+])
+def test_read_shortnames(prototype, shortname):
+    assert read_shortnames()[prototype] == shortname
+
+
+def test_read_shortnames_returns_copy():
+    shortnames = read_shortnames()
+    shortnames["A_cF4_225_a"] = "modified"
+    assert read_shortnames()["A_cF4_225_a"] == "Face-Centered Cubic"
+
+
+@pytest.fixture
+def aflow(tmp_path):
+    stub = tmp_path / "aflow"
+    stub.write_text(STUB_AFLOW.format(python=sys.executable))
+    stub.chmod(stub.stat().st_mode | stat.S_IEXEC)
+    return AFLOW(aflow_executable=str(stub), aflow_work_dir=str(tmp_path), np=2)
+
+
+@pytest.fixture
+def started_processes(monkeypatch):
+    """
+    Record every process started by aflow_command
+    """
+    procs = []
+    real_popen = subprocess.Popen
+
+    def recording_popen(*args, **kwargs):
+        proc = real_popen(*args, **kwargs)
+        procs.append(proc)
+        return proc
+
+    monkeypatch.setattr(aflow_util.core.subprocess, "Popen", recording_popen)
+    return procs
+
+
+def test_single_command(aflow):
+    assert aflow.aflow_command([" --echo hello"]) == "--np=2 --echo hello"
+
+
+def test_input(aflow):
+    assert aflow.aflow_command([" --cat"], input="abc") == "abc"
+
+
+def test_pipe(aflow):
+    assert aflow.aflow_command([" --cat", " --upper"], input="abc") == "ABC"
+    # large enough to fill the pipes if the pipeline wasn't fed and drained concurrently
+    assert aflow.aflow_command([" --cat", " --upper", " --cat"], input="x"*1000000) == "X"*1000000
+
+
+def test_redirections(aflow, tmp_path):
+    (tmp_path / "in.txt").write_text("from file")
+    assert aflow.aflow_command([" --cat < %s" % (tmp_path / "in.txt"), " --upper"]) == "FROM FILE"
+    assert aflow.aflow_command([" --cat > %s" % (tmp_path / "out.txt")], input="to file") == ""
+    assert (tmp_path / "out.txt").read_text() == "to file"
+
+
+def test_failing_command(aflow):
+    with pytest.raises(RuntimeError, match="boom"):
+        aflow.aflow_command([" --cat", " --fail"], input="abc")
+    with pytest.raises(AFLOW.tooSymmetricException):
+        aflow.aflow_command([" --proto=A_cF4_225_a"])
+
+
+def test_missing_input_file(aflow, started_processes, tmp_path):
+    with pytest.raises(RuntimeError, match="unable to run aflow command"):
+        aflow.aflow_command([" --cat", " --upper < %s" % (tmp_path / "nonexistent.txt")], input="abc")
+    # the file is opened before any process is started
+    assert started_processes == []
+
+
+def test_unwritable_output_file(aflow, started_processes, tmp_path):
+    with pytest.raises(RuntimeError, match="unable to run aflow command"):
+        aflow.aflow_command([" --cat > %s" % (tmp_path / "nonexistent_dir" / "out.txt")], input="abc")
+    assert started_processes == []
+
+
+def test_missing_redirection_target(aflow):
+    with pytest.raises(RuntimeError, match="missing file name"):
+        aflow.aflow_command([" --cat <"])
+    with pytest.raises(RuntimeError, match="missing file name"):
+        aflow.aflow_command([" --cat >"])
+
+
+def test_failed_start_cleans_up(aflow, started_processes, monkeypatch):
+    recording_popen = aflow_util.core.subprocess.Popen
+
+    def fail_second_popen(*args, **kwargs):
+        if len(started_processes) == 1:
+            raise OSError("cannot start")
+        return recording_popen(*args, **kwargs)
+
+    monkeypatch.setattr(aflow_util.core.subprocess, "Popen", fail_second_popen)
+    with pytest.raises(RuntimeError, match="cannot start"):
+        aflow.aflow_command([" --cat", " --upper"], input="abc")
+    assert len(started_processes) == 1
+    assert started_processes[0].returncode is not None
+    assert started_processes[0].stdin.closed and started_processes[0].stdout.closed
+
+
+def test_sgdata_cache(aflow, monkeypatch):
+    calls = []
+
+    def fake_aflow_command(cmd, input=None):
+        calls.append(cmd)
+        return '{"space_group_number": 225}'
+
+    monkeypatch.setattr(aflow, "aflow_command", fake_aflow_command)
+    monkeypatch.setattr(aflow_util.core, "_SGDATA_OUTPUTS", {})
+    first = aflow.get_sgdata_from_prototype(["Al"], "A_cF4_225_a", [4.05])
+    first["space_group_number"] = 0
+    # served from the cache, through the instance's aflow_command, and unaffected by changes to the first result
+    assert aflow.get_sgdata_from_prototype(["Al"], "A_cF4_225_a", [4.05]) == {"space_group_number": 225}
+    assert calls == [[" --proto=A_cF4_225_a:Al --params=4.05", " --sgdata --print=json"]]
+
+
+@pytest.mark.parametrize("structures_duplicate,expected", [
+    ([], (None, None)),
+    ([{"name": "A_cF4_225_a", "misfit": 0.1}], ("A_cF4_225_a", "FCC")),
+    # decorated name, found as a substring of the library label
+    ([{"name": "A_cF4_225_a.Cu", "misfit": 0.1}], ("A_cF4_225_a.Cu", "FCC")),
+    # the most specific library label wins
+    ([{"name": "A_cF4_225_a_b.Cu", "misfit": 0.1}], ("A_cF4_225_a_b.Cu", "longer")),
+    # smallest misfit in the list wins over a better misfit that isn't in the list
+    ([{"name": "B_xx", "misfit": 0.05}, {"name": "A_cF4_225_a", "misfit": 0.2}, {"name": "A_cF4_225_a_b", "misfit": 0.1}],
+     ("A_cF4_225_a_b", "longer")),
+    # nothing in the list, return the smallest misfit
+    ([{"name": "B_xx", "misfit": 0.2}, {"name": "C_yy", "misfit": 0.1}], ("C_yy", None)),
+])
+def test_library_prototype_label_and_shortname(aflow, monkeypatch, structures_duplicate, expected):
+    comparison_results = [{"structures_duplicate": structures_duplicate}] if structures_duplicate else []
+    monkeypatch.setattr(aflow, "compare_to_prototypes", lambda *args, **kwargs: comparison_results)
+    shortnames = {"A_cF4_225_a": "FCC", "A_cF4_225_a_b": "longer"}
+    assert aflow.get_library_prototype_label_and_shortname(poscar="", shortnames=shortnames) == expected